@@ -50,9 +50,11 @@ def get_online_Dataloader(args, config, is_train=True):
         return samples.transpose(-1, -2).contiguous()
         # return: (batch_size, channel, max_len)
         
+    worker_kwargs = {'persistent_workers': config['dataloader'].get('persistent_workers', True),
+                     'prefetch_factor': config['dataloader'].get('prefetch_factor', 4)} if config['dataloader']['n_jobs'] > 0 else {}
     dataloader = DataLoader(dataset, batch_size=config['dataloader']['batch_size'],
                             shuffle=is_train, num_workers=config['dataloader']['n_jobs'],
-                            pin_memory=True, collate_fn=collate_fn)
+                            pin_memory=config['dataloader'].get('pin_memory', True), collate_fn=collate_fn, **worker_kwargs)
     return dataloader
 
 
@@ -887,7 +889,8 @@ def get_Dataloader(split, load, data_path, batch_size, max_timestep,
                    use_gpu, n_jobs, train_set, dev_set=[], test_set=[], dev_batch_size=0, 
                    target_path=None, phone_path=None, seed=1337,
                    mam_config=None, sentiment_config=None, online=None,
-                   decode_beam_size=None, train_proportion=1.0, **kwargs):
+                   decode_beam_size=None, train_proportion=1.0, pin_memory=True,
+                   persistent_workers=True, prefetch_factor=4, **kwargs):
 
     # Decide which split to use: train/dev/test
     if split == 'train':
@@ -947,4 +950,6 @@ def get_Dataloader(split, load, data_path, batch_size, max_timestep,
     else:
         raise NotImplementedError('Invalid `load` argument for `get_Dataloader()`!')
 
-    return DataLoader(ds, batch_size=1, shuffle=shuffle, drop_last=False, num_workers=n_jobs, pin_memory=use_gpu)
+    # keep workers alive across epochs and let each of them prepare a few buckets ahead, only valid with subprocesses
+    worker_kwargs = {'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor} if n_jobs > 0 else {}
+    return DataLoader(ds, batch_size=1, shuffle=shuffle, drop_last=False, num_workers=n_jobs, pin_memory=(use_gpu and pin_memory), **worker_kwargs)
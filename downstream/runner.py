@@ -131,7 +131,7 @@ class Runner():
                     # labels: (batch_size, seq_len), LongTensor; or (batch_size), FloatTensor
                     # label_mask: (batch_size, seq_len), LongTensor
                     labels = labels.squeeze(0).to(device=self.device)  # labels can be torch.long or torch.float (regression)
-                    label_mask = (features.sum(dim=-1) != 0).type(torch.LongTensor).to(device=self.device, dtype=torch.long)
+                    label_mask = (features != 0).any(dim=-1).to(device=self.device, dtype=torch.long)
                     if 'utterance' in self.args.run:
                         assert labels.dim() == 1
                         features = features.mean(dim=1).unsqueeze(1) # (batch_size, seq_len=1, feature)
@@ -249,7 +249,7 @@ class Runner():
                     # This variable can be useful for frame-wise metric, like phoneme recognition or speaker verification
                     # label_mask: (batch_size, seq_len), LongTensor
                     labels = labels.squeeze(0).to(device=self.device)
-                    label_mask = (features.sum(dim=-1) != 0).type(torch.LongTensor).to(device=self.device, dtype=torch.long)
+                    label_mask = (features != 0).any(dim=-1).to(device=self.device, dtype=torch.long)
                     if 'utterance' in self.args.run:
                         assert labels.dim() == 1
                         features = features.mean(dim=1).unsqueeze(1) # (batch_size, seq_len=1, feature)
@@ -295,7 +295,7 @@ class Downstream_Trainer(Downstream_Solver):
                     # This variable can be useful for frame-wise metric, like phoneme recognition or speaker verification
                     # label_mask: (batch_size, seq_len), LongTensor
                     # valid_lengths: (batch_size), LongTensor
-                    label_mask = (features.sum(dim=-1) != 0).type(torch.LongTensor).to(device=self.device, dtype=torch.long)
+                    label_mask = (features != 0).any(dim=-1).to(device=self.device, dtype=torch.long)
                     valid_lengths = label_mask.sum(dim=1)
 
                     if self.model_type == 'linear':
@@ -435,7 +435,7 @@ class Downstream_Tester(Downstream_Solver):
                     # For each timestamps, we mark 1 on valid timestamps, and 0 otherwise
                     # This variable can be useful for frame-wise metric, like phoneme recognition or speaker verification
                     # label_mask: (batch_size, seq_len), LongTensor
-                    label_mask = (features.sum(dim=-1) != 0).type(torch.LongTensor).to(device=self.device, dtype=torch.long)
+                    label_mask = (features != 0).any(dim=-1).to(device=self.device, dtype=torch.long)
                     valid_lengths = label_mask.sum(dim=1)
 
                     if self.model_type == 'linear':
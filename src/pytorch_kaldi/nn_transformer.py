@@ -12,7 +12,6 @@
 ###############
 import yaml
 import torch
-import random
 import numpy as np
 import torch.nn as nn
 from functools import lru_cache
@@ -89,6 +88,7 @@ class TRANSFORMER(nn.Module):
 
         # Build model
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self._pe_device = None # full sinusoid table kept on `self.device`
         self.model = TransformerModel(self.model_config, inp_dim).to(self.device)
         self.model.eval() if self.no_grad else self.model.train()
         
@@ -150,11 +150,18 @@ class TRANSFORMER(nn.Module):
         except: print('[Transformer] - Pre-trained weights NOT loaded!')
 
 
+    def device_position_encoding(self, seq_len):
+        ''' Sinusoid position encoding table sliced from a copy kept on `self.device` '''
+        if self._pe_device is None:
+            self._pe_device = get_sinusoid_table(self.hidden_size).to(device=self.device, dtype=torch.float32)
+        return self._pe_device[:seq_len] # (seq_len, hidden_size)
+
+
     def down_sample_frames(self, spec):
-        spec = spec.contiguous()
-        left_over = spec.shape[1] % self.dr
-        if left_over != 0: spec = spec[:, :-left_over, :]
-        spec_stacked = spec.view(spec.shape[0], spec.shape[1]//self.dr, spec.shape[2]*self.dr)
+        seq_len = spec.shape[1] // self.dr * self.dr
+        if seq_len != spec.shape[1]: spec = spec.narrow(1, 0, seq_len)
+        # reshape only copies when the input is not contiguous
+        spec_stacked = spec.reshape(spec.shape[0], seq_len//self.dr, spec.shape[2]*self.dr)
         return spec_stacked
         
 
@@ -175,24 +182,18 @@ class TRANSFORMER(nn.Module):
             spec_stacked = spec
 
         # Record length for each uttr
-        spec_len = np.sum(np.sum(spec_stacked.cpu().data.numpy(), axis=-1) != 0, axis=-1)
-        spec_len = [int(sl) for sl in spec_len]
+        spec_len = (spec_stacked != 0).any(dim=-1).long().sum(dim=-1)
 
-        batch_size = spec_stacked.shape[0]
         seq_len = spec_stacked.shape[1]
 
-        pos_enc = position_encoding(seq_len, self.hidden_size) # (seq_len, hidden_size)
-        attn_mask = np.ones((batch_size, seq_len)) # (batch_size, seq_len)
-
         # zero vectors for padding dimension
-        for idx in range(len(spec_stacked)):
-            attn_mask[idx][spec_len[idx]:] = 0 
+        attn_mask = torch.arange(seq_len, device=spec_len.device).unsqueeze(0) < spec_len.unsqueeze(-1) # (batch_size, seq_len)
 
         if self.spec_aug and self.spec_aug_prev and self.model.training:
             spec_stacked = spec_augment(spec_stacked, mask_T=70, mask_F=4, num_T=2, num_F=2, p=1.0) # (batch_size, seq_len, feature_dim * dr)
         spec_stacked = spec_stacked.to(device=self.device, dtype=torch.float32) # (batch_size, seq_len, feature_dim * dr)
-        pos_enc = torch.FloatTensor(pos_enc).to(device=self.device, dtype=torch.float32).expand(spec_stacked.size(0), *pos_enc.size()) # (batch_size, seq_len, hidden_size)
-        attn_mask = torch.FloatTensor(attn_mask).to(device=self.device, dtype=torch.float32) # (batch_size, seq_len)
+        pos_enc = self.device_position_encoding(seq_len).expand(spec_stacked.size(0), -1, -1) # (batch_size, seq_len, hidden_size)
+        attn_mask = attn_mask.to(device=self.device, dtype=torch.float32) # (batch_size, seq_len)
         return spec_stacked, pos_enc, attn_mask # (x, pos_enc, attention_mask)
 
 
@@ -281,23 +282,12 @@ class TRANSFORMER(nn.Module):
 MAX_SEQLEN = 5000
 @lru_cache(maxsize=1)
 def get_sinusoid_table(hidden_size):
-    def _cal_angle(position, hid_idx):
-        return position / np.power(10000, 2 * (hid_idx // 2) / hidden_size)
-    def _get_posi_angle_vec(position):
-        return [_cal_angle(position, hid_j) for hid_j in range(hidden_size)]
-    sinusoid_table = np.array([_get_posi_angle_vec(pos_i) for pos_i in range(MAX_SEQLEN)])
+    position = np.arange(MAX_SEQLEN)[:, np.newaxis] # (MAX_SEQLEN, 1)
+    hid_idx = np.arange(hidden_size)[np.newaxis, :] # (1, hidden_size)
+    sinusoid_table = position / np.power(10000, 2 * (hid_idx // 2) / hidden_size) # broadcast to (MAX_SEQLEN, hidden_size)
     sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
     sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
-    return torch.FloatTensor(sinusoid_table)
-
-
-def position_encoding(seq_len, hidden_size):
-    """ position encoding table """     
-    table = get_sinusoid_table(hidden_size)[:seq_len]
-    # no extra CPU and GPU memory allocation
-    # after getting the (seq_len, hidden_size) tensor, one should first put
-    # this tensor into GPU then expand it
-    return table  # (seq_len, hidden_size)
+    return torch.from_numpy(sinusoid_table).float()
 
 
 ################
@@ -323,32 +313,25 @@ Output:
 """
 def spec_augment(spec, mask_T=70, mask_F=4, num_T=2, num_F=2, p=1.0):
 
-    def _start_to_intervals(starts, consecutive):
-        tiled = starts.expand(consecutive, starts.size(0)).permute(1, 0)
-        offset = torch.arange(consecutive).expand_as(tiled)
-        intervals = tiled + offset
-        return intervals.view(-1)
+    def _random_bands(batch_size, length, max_width):
+        # one random band of width [0, max_width] per utterance, drawn for the whole batch at once
+        widths = torch.randint(0, max_width + 1, (batch_size,), device=spec.device)
+        starts = (torch.rand(batch_size, device=spec.device) * (length - widths).float()).long()
+        position = torch.arange(length, device=spec.device).unsqueeze(0)
+        return (position >= starts.unsqueeze(-1)) & (position < (starts + widths).unsqueeze(-1)) # (batch_size, length)
 
     with torch.no_grad():
         upper_bound = spec.shape[1] * p # upper bound on the time mask so that a time mask cannot be wider than p times the number of time steps
-        
-        for idx in range(spec.shape[0]):
-
-            # time masking
-            if mask_T > 0 and mask_T < upper_bound:
-                for _ in range(num_T):
-                    rand_consecutive = random.randint(0, mask_T)
-                    chosen_start = torch.randperm(spec.shape[1] - rand_consecutive)[:1]
-                    chosen_intervals = _start_to_intervals(chosen_start, rand_consecutive)
-                    spec[idx, chosen_intervals, :] = 0
-
-            # frequency masking
-            if mask_F > 0:
-                for _ in range(num_F):
-                    rand_bandwidth = random.randint(0, mask_F)
-                    chosen_start = torch.randperm(spec.shape[2] - rand_bandwidth)[:1]
-                    chosen_intervals = _start_to_intervals(chosen_start, rand_bandwidth)
-                    spec[idx, :, chosen_intervals] = 0
+
+        # time masking
+        if mask_T > 0 and mask_T < upper_bound:
+            for _ in range(num_T):
+                spec.masked_fill_(_random_bands(spec.shape[0], spec.shape[1], mask_T).unsqueeze(-1), 0)
+
+        # frequency masking
+        if mask_F > 0:
+            for _ in range(num_F):
+                spec.masked_fill_(_random_bands(spec.shape[0], spec.shape[2], mask_F).unsqueeze(1), 0)
 
         return spec
 
@@ -10,9 +10,7 @@
 ###############
 # IMPORTATION #
 ###############
-import copy
 import torch
-import random
 import numpy as np
 from functools import lru_cache
 
@@ -21,7 +19,6 @@ from functools import lru_cache
 # CONSTANT #
 ############
 DR = 1
-HIDDEN_SIZE = 768
 MASK_PROPORTION = 0.15
 MASK_CONSECUTIVE = 7
 MASK_BUCKET_RATIO = 1.2
@@ -31,24 +28,21 @@ MAX_SEQLEN = 3000
 
 
 def down_sample_frames(spec, dr):
-    left_over = spec.shape[1] % dr
-    if left_over != 0: spec = spec[:, :-left_over, :]
-    spec_stacked = spec.view(spec.shape[0], spec.shape[1]//dr, spec.shape[2]*dr)
+    seq_len = spec.shape[1] // dr * dr
+    if seq_len != spec.shape[1]: spec = spec.narrow(1, 0, seq_len)
+    # reshape only copies when the input is not contiguous
+    spec_stacked = spec.reshape(spec.shape[0], seq_len//dr, spec.shape[2]*dr)
     return spec_stacked
 
 
 @lru_cache(maxsize=128)
 def get_sinusoid_table(hidden_size):
-    def cal_angle(position, hid_idx):
-        return position / np.power(10000, 2 * (hid_idx // 2) / hidden_size)
-        
-    def get_posi_angle_vec(position):
-        return [cal_angle(position, hid_j) for hid_j in range(hidden_size)]
-
-    sinusoid_table = np.array([get_posi_angle_vec(pos_i) for pos_i in range(MAX_SEQLEN)])
+    position = np.arange(MAX_SEQLEN)[:, np.newaxis] # (MAX_SEQLEN, 1)
+    hid_idx = np.arange(hidden_size)[np.newaxis, :] # (1, hidden_size)
+    sinusoid_table = position / np.power(10000, 2 * (hid_idx // 2) / hidden_size) # broadcast to (MAX_SEQLEN, hidden_size)
     sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
     sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
-    return torch.FloatTensor(sinusoid_table)
+    return torch.from_numpy(sinusoid_table).float()
 
 
 def fast_position_encoding(seq_len, hidden_size, batch_size=None, padding_idx=None):
@@ -57,9 +51,9 @@ def fast_position_encoding(seq_len, hidden_size, batch_size=None, padding_idx=No
     table = get_sinusoid_table(hidden_size)[:seq_len]
 
     if padding_idx is not None:
-        # deepcopy will slow down whole process when positional table is too large
+        # copying will slow down whole process when positional table is too large
         # this path is dreprecated and should never be used
-        table = copy.deepcopy(table)
+        table = table.clone()
         table[padding_idx:] = 0. # zero vector for padding dimension
 
     if batch_size is not None:
@@ -77,11 +71,94 @@ def fast_position_encoding(seq_len, hidden_size, batch_size=None, padding_idx=No
         return table  # (seq_len, hidden_size)
 
 
+def sample_starts(candidates, num_starts):
+    ''' Draw `num_starts[b]` positions without replacement from the True entries of each row of `candidates` '''
+    starts = torch.zeros(candidates.shape, dtype=torch.long, device=candidates.device)
+    k = min(int(num_starts.max()), candidates.size(1)) if len(num_starts) > 0 else 0
+    if k > 0:
+        # random scores on valid positions, the top-k of each row is a uniform sample without replacement
+        scores = torch.rand(candidates.shape, device=candidates.device).masked_fill_(~candidates, -1.)
+        top_scores, top_index = scores.topk(k, dim=1)
+        keep = (torch.arange(k, device=candidates.device).unsqueeze(0) < num_starts.unsqueeze(-1)) & (top_scores >= 0)
+        starts.scatter_(1, top_index, keep.long())
+    return starts.bool() # (batch_size, seq_len)
+
+
+def starts_to_intervals(starts, consecutive, start_values=None):
+    ''' Expand a (batch_size, seq_len) boolean map of starts into `consecutive[b]` frames from each start.
+        If `start_values` is given, also return `start_values + offset` propagated along each interval. '''
+    seq_len = starts.size(1)
+    intervals = torch.zeros_like(starts)
+    values = torch.zeros(starts.shape, dtype=torch.long, device=starts.device)
+    for offset in range(min(int(consecutive.max()), seq_len) if len(consecutive) > 0 else 0):
+        shifted = torch.zeros_like(starts)
+        shifted[:, offset:] = starts[:, :seq_len - offset]
+        shifted &= (offset < consecutive).unsqueeze(-1)
+        intervals |= shifted
+        if start_values is not None:
+            shifted_values = torch.zeros_like(values)
+            shifted_values[:, offset:] = start_values[:, :seq_len - offset] + offset
+            values = torch.where(shifted, shifted_values, values)
+    if start_values is not None:
+        return intervals, values
+    return intervals # (batch_size, seq_len)
+
+
+def time_masking(spec_masked, spec_len, mask_proportion, mask_consecutive_min, mask_consecutive_max,
+                 mask_allow_overlap, mask_bucket_ratio):
+    ''' Apply consecutive time masking on the whole batch in place, returns the chosen frames (batch_size, seq_len) '''
+    batch_size, seq_len = spec_masked.shape[0], spec_masked.shape[1]
+    device = spec_masked.device
+    position = torch.arange(seq_len, device=device).unsqueeze(0) # (1, seq_len)
+
+    mask_consecutive = torch.randint(mask_consecutive_min, mask_consecutive_max + 1, (batch_size,), device=device)
+    valid_start_max = (spec_len - mask_consecutive - 1).clamp(min=0) # compute max valid start point for a consecutive mask
+    proportion = torch.round(spec_len.float() * mask_proportion / mask_consecutive.float()).long()
+    if mask_allow_overlap:
+        # draw `proportion` samples from the range (0, valid_index_range) and without replacement
+        candidates = position <= valid_start_max.unsqueeze(-1)
+    else:
+        mask_bucket_size = torch.round(mask_consecutive.float() * mask_bucket_ratio).long().clamp(min=1)
+        rand_start = (torch.rand(batch_size, device=device) * (torch.min(mask_consecutive, valid_start_max) + 1).float()).long()
+        candidates = (position >= rand_start.unsqueeze(-1)) & (position <= valid_start_max.unsqueeze(-1)) & \
+                     ((position - rand_start.unsqueeze(-1)) % mask_bucket_size.unsqueeze(-1) == 0)
+    chosen_starts = sample_starts(candidates, proportion)
+
+    # determine whether to mask / random / or do nothing to the frames of each utterance
+    dice = torch.rand(batch_size, device=device)
+    random_rows = (dice >= 0.8) & (dice < 0.9)
+    # a random source start for every chosen start, the replaced intervals copy consecutive random frames
+    random_starts = (torch.rand(batch_size, seq_len, device=device) * (valid_start_max + 1).unsqueeze(-1).float()).long()
+    chosen_intervals, random_intervals = starts_to_intervals(chosen_starts, mask_consecutive, random_starts)
+    random_intervals = random_intervals.clamp(max=seq_len - 1)
+
+    # replace to random frames
+    replace = chosen_intervals & random_rows.unsqueeze(-1)
+    if replace.any():
+        random_frames = spec_masked.gather(1, random_intervals.unsqueeze(-1).expand_as(spec_masked))
+        spec_masked[replace] = random_frames[replace]
+    # mask to zero
+    spec_masked.masked_fill_((chosen_intervals & (dice < 0.8).unsqueeze(-1)).unsqueeze(-1), 0)
+    # do nothing to the rest
+    return chosen_intervals
+
+
+def frequency_masking(spec_masked, mask_frequency):
+    ''' Apply frequency masking on the whole batch in place, returns the chosen bands (batch_size, feature_dim) '''
+    batch_size, feature_dim = spec_masked.shape[0], spec_masked.shape[2]
+    device = spec_masked.device
+    rand_bandwidth = torch.randint(0, mask_frequency + 1, (batch_size,), device=device)
+    chosen_starts = (torch.rand(batch_size, device=device) * (feature_dim - rand_bandwidth).float()).long()
+    band = torch.arange(feature_dim, device=device).unsqueeze(0) # (1, feature_dim)
+    chosen_intervals = (band >= chosen_starts.unsqueeze(-1)) & (band < (chosen_starts + rand_bandwidth).unsqueeze(-1))
+    spec_masked.masked_fill_(chosen_intervals.unsqueeze(1), 0)
+    return chosen_intervals
+
+
 def process_train_MAM_data(spec, config=None):
     """Process training data for the masked acoustic model"""
 
     dr = config['downsample_rate'] if config is not None else DR
-    hidden_size = config['hidden_size'] if config is not None else HIDDEN_SIZE
     mask_proportion = config['mask_proportion'] if config is not None else MASK_PROPORTION
     mask_consecutive_min = config['mask_consecutive_min'] if config is not None else MASK_CONSECUTIVE
     mask_consecutive_max = config['mask_consecutive_max'] if config is not None else MASK_CONSECUTIVE
@@ -97,7 +174,7 @@ def process_train_MAM_data(spec, config=None):
             target_spec = spec[1]
         elif len(spec) == 1:
             source_spec = spec[0]
-            target_spec = copy.deepcopy(spec[0])
+            target_spec = spec[0].clone()
         else:
             raise NotImplementedError('Input spec sould be either (spec,) or (source_spec, target_spec), where `spec` has shape BxTxD.')
 
@@ -107,94 +184,52 @@ def process_train_MAM_data(spec, config=None):
         assert(spec_masked.shape[1] == spec_stacked.shape[1]), 'Input and output spectrogram should have the same shape'
 
         # Record length for each uttr
-        spec_len = (spec_stacked.sum(dim=-1) != 0).long().sum(dim=-1).tolist()
+        spec_len = (spec_stacked != 0).any(dim=-1).long().sum(dim=-1)
         batch_size = spec_stacked.shape[0]
         seq_len = spec_stacked.shape[1]
         
-        pos_enc = fast_position_encoding(seq_len, hidden_size) # (seq_len, hidden_size)
-        mask_label = torch.zeros_like(spec_stacked, dtype=torch.uint8) \
-                     if mask_proportion != 0 and mask_frequency != 0 else torch.ones_like(spec_stacked, dtype=torch.uint8)
-        attn_mask = torch.ones((batch_size, seq_len)) # (batch_size, seq_len)
-
-        for idx in range(batch_size):
-            # zero vectors for padding dimension
-            attn_mask[idx, spec_len[idx]:] = 0
-
-            if test_reconstruct:
-                mask_label[idx, :, :] = 1
-                continue
+        mask_label = torch.zeros_like(spec_stacked, dtype=torch.bool) \
+                     if mask_proportion != 0 and mask_frequency != 0 else torch.ones_like(spec_stacked, dtype=torch.bool)
+        # zero vectors for padding dimension
+        attn_mask = (torch.arange(seq_len, device=spec_len.device).unsqueeze(0) < spec_len.unsqueeze(-1)).float() # (batch_size, seq_len)
 
-            def starts_to_intervals(starts, consecutive):
-                tiled = starts.expand(consecutive, starts.size(0)).permute(1, 0)
-                offset = torch.arange(consecutive).expand_as(tiled)
-                intervals = tiled + offset
-                return intervals.view(-1)
-            
+        if test_reconstruct:
+            mask_label[:, :, :] = True
+        else:
             # time masking
             if mask_proportion > 0:
-                mask_consecutive = random.randint(mask_consecutive_min, mask_consecutive_max)
-                valid_start_max = max(spec_len[idx] - mask_consecutive - 1, 0) # compute max valid start point for a consecutive mask
-                proportion = round(spec_len[idx] * mask_proportion / mask_consecutive)
-                if mask_allow_overlap:
-                    # draw `proportion` samples from the range (0, valid_index_range) and without replacement
-                    chosen_starts = torch.randperm(valid_start_max + 1)[:proportion]
-                else:
-                    mask_bucket_size = round(mask_consecutive * mask_bucket_ratio)
-                    rand_start = random.randint(0, min(mask_consecutive, valid_start_max))
-                    valid_starts = torch.arange(rand_start, valid_start_max + 1, mask_bucket_size)
-                    chosen_starts = valid_starts[torch.randperm(len(valid_starts))[:proportion]]
-                chosen_intervals = starts_to_intervals(chosen_starts, mask_consecutive)
-                
-                # determine whether to mask / random / or do nothing to the frame
-                dice = random.random()
-                # mask to zero
-                if dice < 0.8:
-                    spec_masked[idx, chosen_intervals, :] = 0
-                # replace to random frames
-                elif dice >= 0.8 and dice < 0.9:
-                    random_starts = torch.randperm(valid_start_max + 1)[:proportion]
-                    random_intervals = starts_to_intervals(random_starts, mask_consecutive)
-                    spec_masked[idx, chosen_intervals, :] = spec_masked[idx, random_intervals, :]
-                # do nothing
-                else:
-                    pass
-
+                chosen_intervals = time_masking(spec_masked, spec_len, mask_proportion, mask_consecutive_min, mask_consecutive_max,
+                                                mask_allow_overlap, mask_bucket_ratio)
                 # the gradients will be calculated on chosen frames
-                mask_label[idx, chosen_intervals, :] = 1
+                mask_label[chosen_intervals] = True
 
             # frequency masking
             if mask_frequency > 0:
-                rand_bandwidth = random.randint(0, mask_frequency)
-                chosen_starts = torch.randperm(spec_masked.shape[2] - rand_bandwidth)[:1]
-                chosen_intervals = starts_to_intervals(chosen_starts, rand_bandwidth)
-                spec_masked[idx, :, chosen_intervals] = 0
-                
+                chosen_intervals = frequency_masking(spec_masked, mask_frequency)
                 # the gradients will be calculated on chosen frames
-                mask_label[idx, :, chosen_intervals] = 1   
+                mask_label.masked_fill_(chosen_intervals.unsqueeze(1), True)
 
         if not test_reconstruct and noise_proportion > 0:
             # noise augmentation
-            dice = random.random()
+            dice = torch.rand(1).item()
             if dice < noise_proportion:
                 noise_sampler = torch.distributions.Normal(0, 0.2)
                 spec_masked += noise_sampler.sample(spec_masked.shape).to(device=spec_masked.device)
         
-        valid_batchid = mask_label.view(batch_size, -1).sum(dim=-1).nonzero().view(-1)
+        valid_batchid = mask_label.view(batch_size, -1).any(dim=-1).nonzero().view(-1)
         batch_is_valid = len(valid_batchid) > 0
         spec_masked = spec_masked.to(dtype=torch.float32)[valid_batchid]
-        pos_enc = pos_enc.to(dtype=torch.float32)
-        mask_label = mask_label.to(dtype=torch.bool)[valid_batchid]
+        mask_label = mask_label[valid_batchid]
         attn_mask = attn_mask.to(dtype=torch.float32)[valid_batchid]
         spec_stacked = spec_stacked.to(dtype=torch.float32)[valid_batchid]
 
-    return batch_is_valid, spec_masked, pos_enc, mask_label, attn_mask, spec_stacked
+    return batch_is_valid, spec_masked, mask_label, attn_mask, spec_stacked
 
 
 def process_test_MAM_data(spec, config=None):
     """Process testing data for the masked acoustic model"""
     
     dr = config['downsample_rate'] if config is not None else DR
-    hidden_size = config['hidden_size'] if config is not None else HIDDEN_SIZE
 
     with torch.no_grad():
         if len(spec) != 1:
@@ -204,29 +239,22 @@ def process_test_MAM_data(spec, config=None):
         spec_stacked = down_sample_frames(spec[0], dr) # (batch_size, seq_len, mel_dim * dr)
 
         # Record length for each uttr
-        spec_len = (spec_stacked.sum(dim=-1) != 0).long().sum(dim=-1).tolist()
-        batch_size = spec_stacked.shape[0]
+        spec_len = (spec_stacked != 0).any(dim=-1).long().sum(dim=-1)
         seq_len = spec_stacked.shape[1]
 
-        pos_enc = fast_position_encoding(seq_len, hidden_size) # (seq_len, hidden_size)
-        attn_mask = torch.ones((batch_size, seq_len)) # (batch_size, seq_len)
-
         # zero vectors for padding dimension
-        for idx in range(len(spec_stacked)):
-            attn_mask[idx, spec_len[idx]:] = 0 
+        attn_mask = (torch.arange(seq_len, device=spec_len.device).unsqueeze(0) < spec_len.unsqueeze(-1)).float() # (batch_size, seq_len)
 
         spec_stacked = spec_stacked.to(dtype=torch.float32)
-        pos_enc = pos_enc.to(dtype=torch.float32)
         attn_mask = attn_mask.to(dtype=torch.float32)
 
-    return spec_stacked, pos_enc, attn_mask # (x, pos_enc, attention_mask)
+    return spec_stacked, attn_mask # (x, attention_mask)
 
 
 def process_dual_train_MAM_data(spec, config=None):
     """Process training data for the masked acoustic model"""
 
     dr = config['downsample_rate'] if config is not None else DR
-    hidden_size = config['hidden_size'] if config is not None else HIDDEN_SIZE
     mask_proportion = config['mask_proportion'] if config is not None else MASK_PROPORTION
     mask_consecutive_min = config['mask_consecutive_min'] if config is not None else MASK_CONSECUTIVE
     mask_consecutive_max = config['mask_consecutive_max'] if config is not None else MASK_CONSECUTIVE
@@ -239,7 +267,7 @@ def process_dual_train_MAM_data(spec, config=None):
     with torch.no_grad():
         
         time_spec = spec[0]
-        target_spec = copy.deepcopy(spec[0])
+        target_spec = spec[0].clone()
         
         # Down sample
         time_masked = down_sample_frames(time_spec, dr) # (batch_size, seq_len, mel_dim * dr)
@@ -250,104 +278,62 @@ def process_dual_train_MAM_data(spec, config=None):
 
         elif len(spec) == 1:
             # create the second dual input for speaker encoder
-            freq_masked = time_masked if mask_proportion == 0 and mask_frequency == 0 else copy.deepcopy(time_masked)
+            freq_masked = time_masked if mask_proportion == 0 and mask_frequency == 0 else time_masked.clone()
         else:
             raise NotImplementedError('Input spec sould be either (spec,) or (source_spec, target_spec), where `spec` has shape BxTxD.')
 
 
         # Record length for each uttr
-        spec_len = (spec_stacked.sum(dim=-1) != 0).long().sum(dim=-1).tolist()
+        spec_len = (spec_stacked != 0).any(dim=-1).long().sum(dim=-1)
         batch_size = spec_stacked.shape[0]
         seq_len = spec_stacked.shape[1]
         
-        pos_enc = fast_position_encoding(seq_len, hidden_size) # (seq_len, hidden_size)
-        mask_label = torch.zeros_like(spec_stacked, dtype=torch.uint8)
-        attn_mask = torch.ones((batch_size, seq_len)) # (batch_size, seq_len)
-
-        for idx in range(batch_size):
-            # zero vectors for padding dimension
-            attn_mask[idx, spec_len[idx]:] = 0
-
-            if test_reconstruct:
-                mask_label[idx, :, :] = 1
-                continue
+        mask_label = torch.zeros_like(spec_stacked, dtype=torch.bool)
+        # zero vectors for padding dimension
+        attn_mask = (torch.arange(seq_len, device=spec_len.device).unsqueeze(0) < spec_len.unsqueeze(-1)).float() # (batch_size, seq_len)
 
-            def starts_to_intervals(starts, consecutive):
-                tiled = starts.expand(consecutive, starts.size(0)).permute(1, 0)
-                offset = torch.arange(consecutive).expand_as(tiled)
-                intervals = tiled + offset
-                return intervals.view(-1)
-            
+        if test_reconstruct:
+            mask_label[:, :, :] = True
+        else:
             # time masking
             if mask_proportion > 0:
-                mask_consecutive = random.randint(mask_consecutive_min, mask_consecutive_max)
-                valid_start_max = max(spec_len[idx] - mask_consecutive - 1, 0) # compute max valid start point for a consecutive mask
-                proportion = round(spec_len[idx] * mask_proportion / mask_consecutive)
-                if mask_allow_overlap:
-                    # draw `proportion` samples from the range (0, valid_index_range) and without replacement
-                    chosen_starts = torch.randperm(valid_start_max + 1)[:proportion]
-                else:
-                    mask_bucket_size = round(mask_consecutive * mask_bucket_ratio)
-                    rand_start = random.randint(0, min(mask_consecutive, valid_start_max))
-                    valid_starts = torch.arange(rand_start, valid_start_max + 1, mask_bucket_size)
-                    chosen_starts = valid_starts[torch.randperm(len(valid_starts))[:proportion]]
-                chosen_intervals = starts_to_intervals(chosen_starts, mask_consecutive)
-                
-                # determine whether to mask / random / or do nothing to the frame
-                dice = random.random()
-                # mask to zero
-                if dice < 0.8:
-                    time_masked[idx, chosen_intervals, :] = 0
-                # replace to random frames
-                elif dice >= 0.8 and dice < 0.9:
-                    random_starts = torch.randperm(valid_start_max + 1)[:proportion]
-                    random_intervals = starts_to_intervals(random_starts, mask_consecutive)
-                    time_masked[idx, chosen_intervals, :] = time_masked[idx, random_intervals, :]
-                # do nothing
-                else:
-                    pass
-
+                chosen_intervals = time_masking(time_masked, spec_len, mask_proportion, mask_consecutive_min, mask_consecutive_max,
+                                                mask_allow_overlap, mask_bucket_ratio)
                 # the gradients will be calculated on chosen frames
-                mask_label[idx, chosen_intervals, :] = 1
+                mask_label[chosen_intervals] = True
 
             # frequency masking
             if mask_frequency > 0:
-                rand_bandwidth = random.randint(0, mask_frequency)
-                chosen_starts = torch.randperm(freq_masked.shape[2] - rand_bandwidth)[:1]
-                chosen_intervals = starts_to_intervals(chosen_starts, rand_bandwidth)
-                freq_masked[idx, :, chosen_intervals] = 0
-                
+                chosen_intervals = frequency_masking(freq_masked, mask_frequency)
                 # the gradients will be calculated on chosen frames
-                mask_label[idx, :, chosen_intervals] = 1   
+                mask_label.masked_fill_(chosen_intervals.unsqueeze(1), True)
 
         if not test_reconstruct and noise_proportion > 0:
             # noise augmentation
-            dice = random.random()
+            dice = torch.rand(1).item()
             noise_sampler = torch.distributions.Normal(0, 0.2)
             if dice < noise_proportion:
                 time_masked += noise_sampler.sample(time_masked.shape).to(device=time_masked.device)
-            dice = random.random()
+            dice = torch.rand(1).item()
             if dice < noise_proportion:
                 freq_masked += noise_sampler.sample(freq_masked.shape).to(device=freq_masked.device)
 
         
-        valid_batchid = mask_label.view(batch_size, -1).sum(dim=-1).nonzero().view(-1)
+        valid_batchid = mask_label.view(batch_size, -1).any(dim=-1).nonzero().view(-1)
         batch_is_valid = len(valid_batchid) > 0
         time_masked = time_masked.to(dtype=torch.float32)[valid_batchid]
         freq_masked = freq_masked.to(dtype=torch.float32)[valid_batchid]
-        pos_enc = pos_enc.to(dtype=torch.float32)
-        mask_label = mask_label.to(dtype=torch.bool)[valid_batchid]
+        mask_label = mask_label[valid_batchid]
         attn_mask = attn_mask.to(dtype=torch.float32)[valid_batchid]
         spec_stacked = spec_stacked.to(dtype=torch.float32)[valid_batchid]
 
-    return batch_is_valid, time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked
+    return batch_is_valid, time_masked, freq_masked, mask_label, attn_mask, spec_stacked
 
 
 def process_wave_train_MAM_data(feats, downsampling, config=None):
     """Process training data for the masked acoustic model"""
 
     dr = config['downsample_rate'] if config is not None else DR
-    hidden_size = config['hidden_size'] if config is not None else HIDDEN_SIZE
 
     with torch.no_grad():
         if len(feats) == 2: # `source_feat` should be raw waveform and `target_spec` should be the matching spectrogram
@@ -365,16 +351,14 @@ def process_wave_train_MAM_data(feats, downsampling, config=None):
         target_spec = target_spec[:, :seq_len, :]
         batch_size = target_spec.shape[0]
         
-        pos_enc = fast_position_encoding(seq_len, hidden_size) # (seq_len, hidden_size)
-        mask_label = torch.ones_like(target_spec, dtype=torch.uint8)
+        mask_label = torch.ones_like(target_spec, dtype=torch.bool)
         attn_mask = torch.ones((batch_size, seq_len)) # (batch_size, seq_len)
         
-        valid_batchid = mask_label.view(batch_size, -1).sum(dim=-1).nonzero().view(-1)
+        valid_batchid = mask_label.view(batch_size, -1).any(dim=-1).nonzero().view(-1)
         batch_is_valid = len(valid_batchid) > 0
         source_feat = source_feat.to(dtype=torch.float32)[valid_batchid]
-        pos_enc = pos_enc.to(dtype=torch.float32)
-        mask_label = mask_label.to(dtype=torch.bool)[valid_batchid]
+        mask_label = mask_label[valid_batchid]
         attn_mask = attn_mask.to(dtype=torch.float32)[valid_batchid]
         target_spec = target_spec.to(dtype=torch.float32)[valid_batchid]
 
-    return batch_is_valid, source_feat, pos_enc, mask_label, attn_mask, target_spec
\ No newline at end of file
+    return batch_is_valid, source_feat, mask_label, attn_mask, target_spec
\ No newline at end of file
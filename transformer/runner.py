@@ -12,16 +12,17 @@
 ###############
 import os
 import math
+import inspect
 import torch
-import random
 import numpy as np
 from tqdm import tqdm
 from tensorboardX import SummaryWriter
 from transformer.model import TransformerConfig, TransformerForMaskedAcousticModel
 from transformer.model_dual import DualTransformerConfig, DualTransformerForMaskedAcousticModel
 from transformer.optimization import BertAdam, Lamb, WarmupLinearSchedule
-from transformer.mam import fast_position_encoding
+from transformer.mam import MAX_SEQLEN, get_sinusoid_table
 from utility.audio import plot_spectrogram_to_numpy
+from utility.helper import CUDAPrefetcher, get_grad_scaler
 
 
 ##########
@@ -59,6 +60,8 @@ class Runner():
         # model
         self.transformer_config = config['transformer']
         self.dr = config['transformer']['downsample_rate']
+        self.hidden_size = config['transformer']['hidden_size']
+        self._pe_device = None # full sinusoid table kept on `self.device`
         self.dual_transformer = config['transformer']['dual_transformer'] if 'dual_transformer' in config['transformer'] else False
         self.wave_transformer = config['transformer']['wave_transformer'] if 'wave_transformer' in config['transformer'] else False
         if 'online' in config:
@@ -92,6 +95,12 @@ class Runner():
             print('[Runner] - Multi-GPU training Enabled: ' + str(torch.cuda.device_count()))
         print('[Runner] - Number of parameters: ' + str(sum(p.numel() for p in self.model.parameters() if p.requires_grad)))
 
+        # Parameters to clip, collected once instead of walking the model every step
+        self.params = [p for p in self.model.parameters() if p.requires_grad]
+        # the foreach implementation batches the norm and scaling over all parameters (torch>=2.0, CUDA tensors)
+        self.clip_kwargs = {'foreach': True} if self.device.type == 'cuda' and \
+                           'foreach' in inspect.signature(torch.nn.utils.clip_grad_norm_).parameters else {}
+
         # Setup optimizer
         param_optimizer = list(self.model.named_parameters())
 
@@ -103,22 +112,14 @@ class Runner():
 
         if 'type' not in self.config['optimizer']:
             self.config['optimizer']['type'] = 'adam'
-        print('[Runner] - Optimizer: ' + ('apex Fused Adam' if self.apex else str(self.config['optimizer']['type'])))
+        print('[Runner] - Optimizer: ' + ('AMP AdamW' if self.apex else str(self.config['optimizer']['type'])))
         if self.apex:
-            try:
-                from apex.optimizers import FP16_Optimizer
-                from apex.optimizers import FusedAdam
-            except ImportError:
-                raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-            optimizer = FusedAdam(optimizer_grouped_parameters,
-                                    lr=self.learning_rate,
-                                    bias_correction=False,
-                                    max_grad_norm=1.0)
-            if self.config['optimizer']['loss_scale'] == 0:
-                self.optimizer = FP16_Optimizer(optimizer, dynamic_loss_scale=True)
-            else:
-                self.optimizer = FP16_Optimizer(optimizer, static_loss_scale=self.config['optimizer']['loss_scale'])
+            # native mixed precision: the fused optimizer updates the fp32 master weights, GradScaler handles the loss scaling
+            optimizer_kwargs = {'fused': True} if self.device.type == 'cuda' and \
+                               'fused' in inspect.signature(torch.optim.AdamW).parameters else {}
+            self.optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
+                                               lr=self.learning_rate,
+                                               **optimizer_kwargs)
             self.warmup_linear = WarmupLinearSchedule(warmup=self.warmup_proportion,
                                                       t_total=self.total_steps)
         elif self.config['optimizer']['type'] == 'adam':
@@ -137,6 +138,8 @@ class Runner():
                                       correct_bias=True if self.config['optimizer']['type'] == 'adamW' else False)
         else:
             raise NotImplementedError()
+        loss_scale = self.config['optimizer']['loss_scale']
+        self.scaler = get_grad_scaler(init_scale=loss_scale if loss_scale > 0 else 2.**16, enabled=self.apex)
 
         if self.args.resume is not None:
             self.load_model(self.args.resume)
@@ -148,6 +151,7 @@ class Runner():
         self.model.Transformer.load_state_dict(ckpt['Transformer'])
         self.model.SpecHead.load_state_dict(ckpt['SpecHead'])
         self.optimizer.load_state_dict(ckpt['Optimizer'])
+        if 'Scaler' in ckpt: self.scaler.load_state_dict(ckpt['Scaler'])
         self.global_step = ckpt['Global_step']
 
 
@@ -173,6 +177,7 @@ class Runner():
             }
 
         all_states['Optimizer'] = self.optimizer.state_dict()
+        all_states['Scaler'] = self.scaler.state_dict()
         all_states['Global_step'] = self.global_step
         all_states['Settings'] = { 'Config': self.config, 'Paras': self.args }
 
@@ -200,36 +205,44 @@ class Runner():
 
 
     def down_sample_frames(self, spec):
-        left_over = spec.shape[1] % self.dr
-        if left_over != 0: spec = spec[:, :-left_over, :]
-        spec_stacked = spec.view(spec.shape[0], spec.shape[1]//self.dr, spec.shape[2]*self.dr)
+        seq_len = spec.shape[1] // self.dr * self.dr
+        if seq_len != spec.shape[1]: spec = spec.narrow(1, 0, seq_len)
+        # reshape only copies when the input is not contiguous
+        spec_stacked = spec.reshape(spec.shape[0], seq_len//self.dr, spec.shape[2]*self.dr)
         return spec_stacked
 
 
+    def device_position_encoding(self, seq_len):
+        ''' Sinusoid position encoding table sliced from a copy kept on `self.device` '''
+        assert seq_len <= MAX_SEQLEN, f'constant MAX_SEQLEN ({MAX_SEQLEN}) in mam.py < received seq_len ({seq_len})'
+        if self._pe_device is None:
+            self._pe_device = get_sinusoid_table(self.hidden_size).to(device=self.device, dtype=torch.float32)
+        return self._pe_device[:seq_len] # (seq_len, hidden_size)
+
+
+    def zero_grad(self):
+        ''' Drop the gradients instead of writing zeros over every parameter '''
+        self.optimizer.zero_grad(set_to_none=True)
+
+
     def process_data(self, spec):
         """Process training data for the masked acoustic model"""
         with torch.no_grad():
             
-            assert(len(spec) == 5), 'dataloader should return (spec_masked, pos_enc, mask_label, attn_mask, spec_stacked)'
+            assert(len(spec) == 4), 'dataloader should return (spec_masked, mask_label, attn_mask, spec_stacked)'
             # Unpack and Hack bucket: Bucketing should cause acoustic feature to have shape 1xBxTxD'
             spec_masked = spec[0].squeeze(0)
-            pos_enc = spec[1].squeeze(0)
-            mask_label = spec[2].squeeze(0)
-            attn_mask = spec[3].squeeze(0)
-            spec_stacked = spec[4].squeeze(0)
-
-            spec_masked = spec_masked.to(device=self.device)
-            if pos_enc.dim() == 3:
-                # pos_enc: (batch_size, seq_len, hidden_size)
-                # GPU memory need (batch_size * seq_len * hidden_size)
-                pos_enc = pos_enc.float().to(device=self.device)
-            elif pos_enc.dim() == 2:
-                # pos_enc: (seq_len, hidden_size)
-                # GPU memory only need (seq_len * hidden_size) even after expanded
-                pos_enc = pos_enc.float().to(device=self.device).expand(spec_masked.size(0), *pos_enc.size())
-            mask_label = mask_label.bool().to(device=self.device)
-            attn_mask = attn_mask.float().to(device=self.device)
-            spec_stacked = spec_stacked.to(device=self.device)
+            mask_label = spec[1].squeeze(0)
+            attn_mask = spec[2].squeeze(0)
+            spec_stacked = spec[3].squeeze(0)
+
+            spec_masked = spec_masked.to(device=self.device, non_blocking=True)
+            # pos_enc: (seq_len, hidden_size), the same sinusoid table for every batch
+            # so it is sliced from the copy kept on device instead of being sent by the dataloader
+            pos_enc = self.device_position_encoding(spec_stacked.size(1)).expand(spec_masked.size(0), -1, -1)
+            mask_label = mask_label.bool().to(device=self.device, non_blocking=True)
+            attn_mask = attn_mask.float().to(device=self.device, non_blocking=True)
+            spec_stacked = spec_stacked.to(device=self.device, non_blocking=True)
 
         return spec_masked, pos_enc, mask_label, attn_mask, spec_stacked # (x, pos_enc, mask_label, attention_mask. y)
 
@@ -238,28 +251,22 @@ class Runner():
         """Process training data for the dual masked acoustic model"""
         with torch.no_grad():
             
-            assert(len(spec) == 6), 'dataloader should return (time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked)'
+            assert(len(spec) == 5), 'dataloader should return (time_masked, freq_masked, mask_label, attn_mask, spec_stacked)'
             # Unpack and Hack bucket: Bucketing should cause acoustic feature to have shape 1xBxTxD'
             time_masked = spec[0].squeeze(0)
             freq_masked = spec[1].squeeze(0)
-            pos_enc = spec[2].squeeze(0)
-            mask_label = spec[3].squeeze(0)
-            attn_mask = spec[4].squeeze(0)
-            spec_stacked = spec[5].squeeze(0)
-
-            time_masked = time_masked.to(device=self.device)
-            freq_masked = freq_masked.to(device=self.device)
-            if pos_enc.dim() == 3:
-                # pos_enc: (batch_size, seq_len, hidden_size)
-                # GPU memory need (batch_size * seq_len * hidden_size)
-                pos_enc = pos_enc.float().to(device=self.device)
-            elif pos_enc.dim() == 2:
-                # pos_enc: (seq_len, hidden_size)
-                # GPU memory only need (seq_len * hidden_size) even after expanded
-                pos_enc = pos_enc.float().to(device=self.device).expand(time_masked.size(0), *pos_enc.size())
-            mask_label = mask_label.bool().to(device=self.device)
-            attn_mask = attn_mask.float().to(device=self.device)
-            spec_stacked = spec_stacked.to(device=self.device)
+            mask_label = spec[2].squeeze(0)
+            attn_mask = spec[3].squeeze(0)
+            spec_stacked = spec[4].squeeze(0)
+
+            time_masked = time_masked.to(device=self.device, non_blocking=True)
+            freq_masked = freq_masked.to(device=self.device, non_blocking=True)
+            # pos_enc: (seq_len, hidden_size), the same sinusoid table for every batch
+            # so it is sliced from the copy kept on device instead of being sent by the dataloader
+            pos_enc = self.device_position_encoding(spec_stacked.size(1)).expand(time_masked.size(0), -1, -1)
+            mask_label = mask_label.bool().to(device=self.device, non_blocking=True)
+            attn_mask = attn_mask.float().to(device=self.device, non_blocking=True)
+            spec_stacked = spec_stacked.to(device=self.device, non_blocking=True)
 
         return time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked # (x, pos_enc, mask_label, attention_mask. y)
 
@@ -269,61 +276,63 @@ class Runner():
 
         pbar = tqdm(total=self.total_steps)
         pbar.n = self.global_step - 1
+        self.zero_grad() # afterwards gradients are only cleared right after each optimizer step
 
         while self.global_step <= self.total_steps:
 
             progress = tqdm(self.dataloader, desc="Iteration")
+            # the next batch is processed and copied to device while the current one is computed
+            prefetcher = CUDAPrefetcher(progress, self.process_dual_data if self.dual_transformer else self.process_data, self.device)
 
             step = 0
             loss_val = 0
-            for batch in progress:
-                batch_is_valid, *batch = batch
+            for batch_is_valid, batch in prefetcher:
                 try:
                     if self.global_step > self.total_steps: break
                     if not batch_is_valid: continue
                     step += 1
+                    is_accum_boundary = step % self.gradient_accumulation_steps == 0 # `step` counts the micro-steps taken so far
                     
-                    if self.dual_transformer:
-                        time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked = self.process_dual_data(batch)
-                        loss, pred_spec = self.model(time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked)
-                    else:
-                        spec_masked, pos_enc, mask_label, attn_mask, spec_stacked = self.process_data(batch)
-                        loss, pred_spec = self.model(spec_masked, pos_enc, mask_label, attn_mask, spec_stacked)
+                    with torch.autocast(device_type=self.device.type, dtype=torch.float16, enabled=self.apex):
+                        if self.dual_transformer:
+                            time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked = batch
+                            loss, pred_spec = self.model(time_masked, freq_masked, pos_enc, mask_label, attn_mask, spec_stacked)
+                        else:
+                            spec_masked, pos_enc, mask_label, attn_mask, spec_stacked = batch
+                            loss, pred_spec = self.model(spec_masked, pos_enc, mask_label, attn_mask, spec_stacked)
                     
                     # Accumulate Loss
                     if self.gradient_accumulation_steps > 1:
                         loss = loss / self.gradient_accumulation_steps
                     if self.apex and self.args.multi_gpu:
                         raise NotImplementedError
-                    elif self.apex:
-                        self.optimizer.backward(loss)
                     elif self.args.multi_gpu:
                         loss = loss.sum()
-                        loss.backward()
-                    else:
-                        loss.backward()
+                    self.scaler.scale(loss).backward()
                     loss_val += loss.item()
 
                     # Update
-                    if (step+1) % self.gradient_accumulation_steps == 0:
+                    if is_accum_boundary:
                         if self.apex:
                             # modify learning rate with special warm up BERT uses
-                            # if conifg.apex is False, BertAdam is used and handles this automatically
+                            # if conifg.apex is False, BertAdam (or Lamb) is used and handles this automatically
                             lr_this_step = self.learning_rate * self.warmup_linear.get_lr(self.global_step, self.warmup_proportion)
                             for param_group in self.optimizer.param_groups:
                                 param_group['lr'] = lr_this_step
                         
                         # Step
-                        grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.gradient_clipping)
+                        self.scaler.unscale_(self.optimizer) # clip the true gradients, not the scaled ones
+                        grad_norm = torch.nn.utils.clip_grad_norm_(self.params, self.gradient_clipping, **self.clip_kwargs)
                         if math.isnan(grad_norm):
                             print('[Runner] - Error : grad norm is NaN @ step ' + str(self.global_step))
                         else:
-                            self.optimizer.step()
-                        self.optimizer.zero_grad()
+                            self.scaler.step(self.optimizer) # skipped by the scaler if the fp16 gradients overflowed
+                        self.scaler.update()
+                        self.zero_grad() # NaN gradients are dropped as well, so they cannot leak into the next update
 
                         if self.global_step % self.log_step == 0:
                             # Log
-                            self.log.add_scalar('lr', self.optimizer.get_lr()[0], self.global_step)
+                            self.log.add_scalar('lr', lr_this_step if self.apex else self.optimizer.get_lr()[0], self.global_step)
                             self.log.add_scalar('loss', (loss_val), self.global_step)
                             self.log.add_scalar('gradient norm', grad_norm, self.global_step)
                             progress.set_description("Loss %.4f" % (loss_val))
@@ -345,7 +354,7 @@ class Runner():
                                     self.log.add_audio(name_list[0], spec_list[0][0].data.cpu().numpy(), self.global_step, self.config['online']['sample_rate'])
                                     continue
                                 spec = self.up_sample_frames(spec_list[i][0], return_first=True)
-                                spec = plot_spectrogram_to_numpy(spec.data.cpu().numpy())
+                                spec = plot_spectrogram_to_numpy(spec.data.float().cpu().numpy())
                                 self.log.add_image(name_list[i], spec, self.global_step)
 
                         loss_val = 0
@@ -356,7 +365,7 @@ class Runner():
                     if 'CUDA out of memory' in str(e):
                         print('CUDA out of memory at step: ', self.global_step)
                         torch.cuda.empty_cache()
-                        self.optimizer.zero_grad()
+                        self.zero_grad()
                     else:
                         raise
                 
@@ -12,11 +12,9 @@
 ###############
 import os
 import torch
-import copy
 import math
-import random
+import inspect
 import librosa
-import numpy as np
 from shutil import copyfile
 from tqdm import tqdm, trange
 import torch.nn.functional as F
@@ -24,9 +22,10 @@ from tensorboardX import SummaryWriter
 from dataloader import get_Dataloader
 from transformer.model import TransformerConfig, TransformerModel, TransformerForMaskedAcousticModel
 from transformer.optimization import BertAdam, WarmupLinearSchedule
-from transformer.mam import fast_position_encoding
+from transformer.mam import MAX_SEQLEN, get_sinusoid_table, sample_starts
 from utility.audio import plot_spectrogram_to_numpy, plot_spectrogram, plot_embedding, plot_attention
 from utility.audio import sample_rate, inv_spectrogram
+from utility.helper import CUDAPrefetcher, get_grad_scaler
 
 
 ##########
@@ -63,6 +62,8 @@ class Solver():
         else:
             raise ValueError('Please update your config file to include the attribute `input_dim`.')
 
+        self._pe_device = None # full sinusoid table kept on `self.device`
+
 
     def verbose(self, msg, end='\n'):
         ''' Verbose function for print information to stdout'''
@@ -119,6 +120,12 @@ class Solver():
         elif not inference:
             self.model.train()
 
+            # Parameters to clip, collected once instead of walking the model every step
+            self.params = [p for p in self.model.parameters() if p.requires_grad]
+            # the foreach implementation batches the norm and scaling over all parameters (torch>=2.0, CUDA tensors)
+            self.clip_kwargs = {'foreach': True} if self.device.type == 'cuda' and \
+                               'foreach' in inspect.signature(torch.nn.utils.clip_grad_norm_).parameters else {}
+
             # Setup optimizer
             param_optimizer = list(self.model.named_parameters())
 
@@ -129,20 +136,12 @@ class Solver():
                 ]
 
             if self.apex:
-                try:
-                    from apex.optimizers import FP16_Optimizer
-                    from apex.optimizers import FusedAdam
-                except ImportError:
-                    raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-                optimizer = FusedAdam(optimizer_grouped_parameters,
-                                      lr=self.learning_rate,
-                                      bias_correction=False,
-                                      max_grad_norm=1.0)
-                if self.config['optimizer']['loss_scale'] == 0:
-                    self.optimizer = FP16_Optimizer(optimizer, dynamic_loss_scale=True)
-                else:
-                    self.optimizer = FP16_Optimizer(optimizer, static_loss_scale=self.config['optimizer']['loss_scale'])
+                # native mixed precision: the fused optimizer updates the fp32 master weights, GradScaler handles the loss scaling
+                optimizer_kwargs = {'fused': True} if self.device.type == 'cuda' and \
+                                   'fused' in inspect.signature(torch.optim.AdamW).parameters else {}
+                self.optimizer = torch.optim.AdamW(optimizer_grouped_parameters,
+                                                   lr=self.learning_rate,
+                                                   **optimizer_kwargs)
                 self.warmup_linear = WarmupLinearSchedule(warmup=self.warmup_proportion,
                                                           t_total=self.total_steps)
             else:
@@ -150,6 +149,8 @@ class Solver():
                                         lr=self.learning_rate,
                                         warmup=self.warmup_proportion,
                                         t_total=self.total_steps)
+            loss_scale = self.config['optimizer']['loss_scale']
+            self.scaler = get_grad_scaler(init_scale=loss_scale if loss_scale > 0 else 2.**16, enabled=self.apex)
         else:
             raise NotImplementedError('Invalid Arguments!')
 
@@ -163,6 +164,7 @@ class Solver():
                 'SpecHead': self.model.SpecHead.state_dict() if not self.paras.multi_gpu else self.model.module.SpecHead.state_dict(),
                 'Transformer': self.transformer.state_dict() if not self.paras.multi_gpu else self.transformer.module.state_dict(),
                 'Optimizer': self.optimizer.state_dict(),
+                'Scaler': self.scaler.state_dict(),
                 'Global_step': self.global_step,
                 'Settings': {
                     'Config': self.config,
@@ -268,6 +270,7 @@ class Solver():
                     for k, v in state.items():
                         if torch.is_tensor(v):
                             state[k] = v.cuda()
+                if 'Scaler' in all_states: self.scaler.load_state_dict(all_states['Scaler'])
                 self.verbose('[Optimizer] - Loaded')
             except: self.verbose('[Optimizer - X]')
 
@@ -291,33 +294,19 @@ class Solver():
 
 
     def down_sample_frames(self, spec):
-        left_over = spec.shape[1] % self.dr
-        if left_over != 0: spec = spec[:, :-left_over, :]
-        spec_stacked = spec.view(spec.shape[0], spec.shape[1]//self.dr, spec.shape[2]*self.dr)
+        seq_len = spec.shape[1] // self.dr * self.dr
+        if seq_len != spec.shape[1]: spec = spec.narrow(1, 0, seq_len)
+        # reshape only copies when the input is not contiguous
+        spec_stacked = spec.reshape(spec.shape[0], seq_len//self.dr, spec.shape[2]*self.dr)
         return spec_stacked
 
 
-    def position_encoding(self, seq_len, batch_size=None, padding_idx=None):
-        ''' Sinusoid position encoding table '''
-        def cal_angle(position, hid_idx):
-            return position / np.power(10000, 2 * (hid_idx // 2) / self.hidden_size)
-     
-        def get_posi_angle_vec(position):
-            return [cal_angle(position, hid_j) for hid_j in range(self.hidden_size)]
-
-        sinusoid_table = np.array([get_posi_angle_vec(pos_i) for pos_i in range(seq_len)])
-
-        sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
-        sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
-
-        if padding_idx is not None:
-            sinusoid_table[padding_idx:] = 0. # zero vector for padding dimension
-
-        if batch_size is not None:
-            batch_sinusoid_table = np.repeat(sinusoid_table[np.newaxis,...], batch_size, axis=0)
-            return batch_sinusoid_table # (batch_size, seq_len, hidden_size)
-        else:
-            return sinusoid_table  # (seq_len, hidden_size)
+    def device_position_encoding(self, seq_len):
+        ''' Sinusoid position encoding table sliced from a copy kept on `self.device` '''
+        assert seq_len <= MAX_SEQLEN, f'constant MAX_SEQLEN ({MAX_SEQLEN}) in mam.py < received seq_len ({seq_len})'
+        if self._pe_device is None:
+            self._pe_device = get_sinusoid_table(self.hidden_size).to(device=self.device, dtype=torch.float32)
+        return self._pe_device[:seq_len] # (seq_len, hidden_size)
 
 
 ###########
@@ -353,30 +342,29 @@ class Trainer(Solver):
         self.global_step = 0
 
 
+    def zero_grad(self):
+        ''' Drop the gradients instead of writing zeros over every parameter '''
+        self.optimizer.zero_grad(set_to_none=True)
+
+
     def process_data(self, spec):
         """Process training data for the masked acoustic model"""
         with torch.no_grad():
             
-            assert(len(spec) == 5), 'dataloader should return (spec_masked, pos_enc, mask_label, attn_mask, spec_stacked)'
+            assert(len(spec) == 4), 'dataloader should return (spec_masked, mask_label, attn_mask, spec_stacked)'
             # Unpack and Hack bucket: Bucketing should cause acoustic feature to have shape 1xBxTxD'
             spec_masked = spec[0].squeeze(0)
-            pos_enc = spec[1].squeeze(0)
-            mask_label = spec[2].squeeze(0)
-            attn_mask = spec[3].squeeze(0)
-            spec_stacked = spec[4].squeeze(0)
-
-            spec_masked = spec_masked.to(device=self.device)
-            if pos_enc.dim() == 3:
-                # pos_enc: (batch_size, seq_len, hidden_size)
-                # GPU memory need (batch_size * seq_len * hidden_size)
-                pos_enc = torch.FloatTensor(pos_enc).to(device=self.device)
-            elif pos_enc.dim() == 2:
-                # pos_enc: (seq_len, hidden_size)
-                # GPU memory only need (seq_len * hidden_size) even after expanded
-                pos_enc = torch.FloatTensor(pos_enc).to(device=self.device).expand(spec_masked.size(0), *pos_enc.size())
-            mask_label = torch.ByteTensor(mask_label).to(device=self.device)
-            attn_mask = torch.FloatTensor(attn_mask).to(device=self.device)
-            spec_stacked = spec_stacked.to(device=self.device)
+            mask_label = spec[1].squeeze(0)
+            attn_mask = spec[2].squeeze(0)
+            spec_stacked = spec[3].squeeze(0)
+
+            spec_masked = spec_masked.to(device=self.device, non_blocking=True)
+            # pos_enc: (seq_len, hidden_size), the same sinusoid table for every batch
+            # so it is sliced from the copy kept on device instead of being sent by the dataloader
+            pos_enc = self.device_position_encoding(spec_stacked.size(1)).expand(spec_masked.size(0), -1, -1)
+            mask_label = mask_label.bool().to(device=self.device, non_blocking=True)
+            attn_mask = attn_mask.float().to(device=self.device, non_blocking=True)
+            spec_stacked = spec_stacked.to(device=self.device, non_blocking=True)
 
         return spec_masked, pos_enc, mask_label, attn_mask, spec_stacked # (x, pos_enc, mask_label, attention_mask. y)
 
@@ -386,35 +374,36 @@ class Trainer(Solver):
         self.verbose('Training set total ' + str(len(self.dataloader)) + ' batches.')
 
         pbar = tqdm(total=self.total_steps)
+        self.zero_grad() # afterwards gradients are only cleared right after each optimizer step
         while self.global_step <= self.total_steps:
 
             progress = tqdm(self.dataloader, desc="Iteration")
+            # the next batch is processed and copied to device while the current one is computed
+            prefetcher = CUDAPrefetcher(progress, self.process_data, self.device)
 
             step = 0
-            for batch_is_valid, *batch in progress:
+            for batch_is_valid, batch in prefetcher:
                 try:
                     if self.global_step > self.total_steps: break
                     if not batch_is_valid: continue
                     step += 1
+                    is_accum_boundary = step % self.gradient_accumulation_steps == 0 # `step` counts the micro-steps taken so far
                     
-                    spec_masked, pos_enc, mask_label, attn_mask, spec_stacked = self.process_data(batch)
-                    loss, pred_spec = self.model(spec_masked, pos_enc, mask_label, attn_mask, spec_stacked)
+                    spec_masked, pos_enc, mask_label, attn_mask, spec_stacked = batch
+                    with torch.autocast(device_type=self.device.type, dtype=torch.float16, enabled=self.apex):
+                        loss, pred_spec = self.model(spec_masked, pos_enc, mask_label, attn_mask, spec_stacked)
                     
                     # Accumulate Loss
                     if self.gradient_accumulation_steps > 1:
                         loss = loss / self.gradient_accumulation_steps
                     if self.apex and self.paras.multi_gpu:
                         raise NotImplementedError
-                    elif self.apex:
-                        self.optimizer.backward(loss)
                     elif self.paras.multi_gpu:
                         loss = loss.sum()
-                        loss.backward()
-                    else:
-                        loss.backward()
+                    self.scaler.scale(loss).backward()
 
                     # Update
-                    if (step+1) % self.gradient_accumulation_steps == 0:
+                    if is_accum_boundary:
                         if self.apex:
                             # modify learning rate with special warm up BERT uses
                             # if conifg.apex is False, BertAdam is used and handles this automatically
@@ -423,16 +412,18 @@ class Trainer(Solver):
                                 param_group['lr'] = lr_this_step
                         
                         # Step
-                        grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.gradient_clipping)
+                        self.scaler.unscale_(self.optimizer) # clip the true gradients, not the scaled ones
+                        grad_norm = torch.nn.utils.clip_grad_norm_(self.params, self.gradient_clipping, **self.clip_kwargs)
                         if math.isnan(grad_norm):
                             self.verbose('Error : grad norm is NaN @ step ' + str(self.global_step))
                         else:
-                            self.optimizer.step()
-                        self.optimizer.zero_grad()
+                            self.scaler.step(self.optimizer) # skipped by the scaler if the fp16 gradients overflowed
+                        self.scaler.update()
+                        self.zero_grad() # NaN gradients are dropped as well, so they cannot leak into the next update
 
                         if self.global_step % self.log_step == 0:
                             # Log
-                            self.log.add_scalar('lr', self.optimizer.get_lr()[0], self.global_step)
+                            self.log.add_scalar('lr', lr_this_step if self.apex else self.optimizer.get_lr()[0], self.global_step)
                             self.log.add_scalar('loss', (loss.item() * self.gradient_accumulation_steps), self.global_step)
                             self.log.add_scalar('gradient norm', grad_norm, self.global_step)
                             progress.set_description("Loss %.4f" % (loss.item() * self.gradient_accumulation_steps))
@@ -440,7 +431,7 @@ class Trainer(Solver):
                         if self.global_step % self.save_step == 0:
                             self.save_model('states')
                             mask_spec = self.up_sample_frames(spec_masked[0], return_first=True)
-                            pred_spec = self.up_sample_frames(pred_spec[0], return_first=True)
+                            pred_spec = self.up_sample_frames(pred_spec[0].float(), return_first=True)
                             true_spec = self.up_sample_frames(spec_stacked[0], return_first=True)
                             mask_spec = plot_spectrogram_to_numpy(mask_spec.data.cpu().numpy())
                             pred_spec = plot_spectrogram_to_numpy(pred_spec.data.cpu().numpy())
@@ -456,7 +447,7 @@ class Trainer(Solver):
                     if 'CUDA out of memory' in str(e):
                         print('CUDA out of memory at step: ', self.global_step)
                         torch.cuda.empty_cache()
-                        self.optimizer.zero_grad()
+                        self.zero_grad()
                     else:
                         raise
                 
@@ -505,58 +496,48 @@ class Tester(Solver):
 
     def process_MAM_data(self, spec):
         """Process testing data for the masked acoustic model"""
-        
-        # Hack bucket if spec is loaded from the dataloader
-        if len(spec.shape) == 4: # Bucketing should cause acoustic feature to have shape 1xBxTxD
-            spec = spec.squeeze(0)
-        # add arbitary batch axis B if input `spec` has shape of TxD
-        elif len(spec.shape) == 2:
-            spec = spec.unsqueeze(0)
-        # input `spec` should have shape BxTxD
-        elif len(spec.shape) != 3:
-            raise ValueError('Input argument `spec` has invalid shape: {}'.format(spec.shape))
 
-        # Down sample
-        spec_stacked = self.down_sample_frames(spec) # (batch_size, seq_len, mel_dim * dr)
+        with torch.no_grad():
+            # Hack bucket if spec is loaded from the dataloader
+            if len(spec.shape) == 4: # Bucketing should cause acoustic feature to have shape 1xBxTxD
+                spec = spec.squeeze(0)
+            # add arbitary batch axis B if input `spec` has shape of TxD
+            elif len(spec.shape) == 2:
+                spec = spec.unsqueeze(0)
+            # input `spec` should have shape BxTxD
+            elif len(spec.shape) != 3:
+                raise ValueError('Input argument `spec` has invalid shape: {}'.format(spec.shape))
 
-        # Record length for each uttr
-        spec_len = np.sum(np.sum(spec_stacked.data.numpy(), axis=-1) != 0, axis=-1)
-        spec_len = [int(sl) for sl in spec_len]
+            # Down sample
+            spec_stacked = self.down_sample_frames(spec) # (batch_size, seq_len, mel_dim * dr)
+            spec_stacked = spec_stacked.to(device=self.device, dtype=torch.float32, non_blocking=True)
 
-        batch_size = spec_stacked.shape[0]
-        seq_len = spec_stacked.shape[1]
+            # Record length for each uttr, on device instead of a numpy copy
+            spec_len = (spec_stacked != 0).any(dim=-1).long().sum(dim=-1)
 
-        pos_enc = fast_position_encoding(seq_len, self.hidden_size) # (seq_len, hidden_size)
-        attn_mask = np.ones((batch_size, seq_len)) # (batch_size, seq_len)
+            batch_size = spec_stacked.shape[0]
+            seq_len = spec_stacked.shape[1]
 
-        # zero vectors for padding dimension
-        for idx in range(len(spec_stacked)):
-            attn_mask[idx][spec_len[idx]:] = 0 
+            # zero vectors for padding dimension
+            attn_mask = (torch.arange(seq_len, device=self.device).unsqueeze(0) < spec_len.unsqueeze(-1)).float() # (batch_size, seq_len)
 
-        spec_stacked = spec_stacked.to(device=self.device, dtype=torch.float32)
-        pos_enc = torch.FloatTensor(pos_enc).to(device=self.device, dtype=torch.float32).expand(spec_stacked.size(0), *pos_enc.size())
-        attn_mask = torch.FloatTensor(attn_mask).to(device=self.device, dtype=torch.float32)
-        return spec_stacked, pos_enc, attn_mask # (x, pos_enc, attention_mask)
+            pos_enc = self.device_position_encoding(seq_len).expand(batch_size, -1, -1) # (batch_size, seq_len, hidden_size)
+            return spec_stacked, pos_enc, attn_mask # (x, pos_enc, attention_mask)
 
 
     def process_data(self, spec):
-        assert(len(spec) == 3), 'dataloader should return (spec_stacked, pos_enc, attn_mask)'
-        # Unpack and Hack bucket: Bucketing should cause acoustic feature to have shape 1xBxTxD'
-        spec_stacked = spec[0].squeeze(0)
-        pos_enc = spec[1].squeeze(0)
-        attn_mask = spec[2].squeeze(0)
+        with torch.no_grad():
+            assert(len(spec) == 2), 'dataloader should return (spec_stacked, attn_mask)'
+            # Unpack and Hack bucket: Bucketing should cause acoustic feature to have shape 1xBxTxD'
+            spec_stacked = spec[0].squeeze(0)
+            attn_mask = spec[1].squeeze(0)
     
-        spec_stacked = spec_stacked.to(device=self.device)
-        if pos_enc.dim() == 3:
-            # pos_enc: (batch_size, seq_len, hidden_size)
-            # GPU memory need (batch_size * seq_len * hidden_size)
-            pos_enc = torch.FloatTensor(pos_enc).to(device=self.device)
-        elif pos_enc.dim() == 2:
-            # pos_enc: (seq_len, hidden_size)
-            # GPU memory only need (seq_len * hidden_size) even after expanded
-            pos_enc = torch.FloatTensor(pos_enc).to(device=self.device).expand(spec_stacked.size(0), *pos_enc.size())
-        attn_mask = torch.FloatTensor(attn_mask).to(device=self.device)
-        return spec_stacked, pos_enc, attn_mask # (x, pos_enc, attention_mask)
+            spec_stacked = spec_stacked.to(device=self.device, non_blocking=True)
+            # pos_enc: (seq_len, hidden_size), the same sinusoid table for every batch
+            # so it is sliced from the copy kept on device instead of being sent by the dataloader
+            pos_enc = self.device_position_encoding(spec_stacked.size(1)).expand(spec_stacked.size(0), -1, -1)
+            attn_mask = attn_mask.float().to(device=self.device, non_blocking=True)
+            return spec_stacked, pos_enc, attn_mask # (x, pos_enc, attention_mask)
 
 
     def tile_representations(self, reps):
@@ -593,10 +574,11 @@ class Tester(Solver):
                     pred_spec, _ = self.model(spec_stacked, pos_enc, attention_mask=attn_mask)
                     
                     # generate the model filled MAM spectrogram
-                    spec_masked = copy.deepcopy(spec_stacked)
-                    for i in range(len(spec_masked)):
-                        sample_index = random.sample(range(len(spec_masked[i])), int(len(spec_masked[i])*self.transformer_config['mask_proportion']))
-                        spec_masked[i][sample_index] = 0
+                    spec_masked = spec_stacked.clone()
+                    batch_size, seq_len = spec_masked.shape[0], spec_masked.shape[1]
+                    num_masked = torch.full((batch_size,), int(seq_len*self.transformer_config['mask_proportion']), dtype=torch.long, device=spec_masked.device)
+                    sample_index = sample_starts(torch.ones(batch_size, seq_len, dtype=torch.bool, device=spec_masked.device), num_masked)
+                    spec_masked.masked_fill_(sample_index.unsqueeze(-1), 0)
                     fill_spec, _ = self.model(spec_masked, pos_enc, attention_mask=attn_mask)
                     
                     # plot reconstructed / ground-truth / MAM filled spectrogram
@@ -66,4 +66,71 @@ def get_transformer_tester(from_path='result/result_transformer/libri_sd1337_fml
     from transformer.solver import Tester
     tester = Tester(config, paras)
     tester.set_model(inference=True, with_head=False, from_path=from_path)
-    return tester
\ No newline at end of file
+    return tester
+
+###################
+# CUDA PREFETCHER #
+###################
+class CUDAPrefetcher():
+    ''' Iterate a loader of (batch_is_valid, *batch) and run `process_fn` for the next batch on a side CUDA stream,
+        so its host-to-device copies overlap with the forward / backward of the current batch.
+        Yields (batch_is_valid, processed_batch), where `processed_batch` is None for invalid batches,
+        including batches dropped because copying them ran out of CUDA memory.
+        On CPU devices `process_fn` is simply called in order.
+    '''
+    def __init__(self, loader, process_fn, device):
+        self.loader = iter(loader)
+        self.process_fn = process_fn
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.preload()
+
+    def preload(self):
+        try:
+            batch_is_valid, *batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if not batch_is_valid:
+            self.next_batch = (False, None)
+            return
+        try:
+            if self.stream is None:
+                self.next_batch = (True, self.process_fn(batch))
+            else:
+                with torch.cuda.stream(self.stream):
+                    self.next_batch = (True, self.process_fn(batch))
+        except RuntimeError as e:
+            # this runs outside the training loop's OOM handler, so an OOM while copying only drops this batch
+            if 'CUDA out of memory' in str(e):
+                print('CUDA out of memory while preparing a batch, skipped')
+                torch.cuda.empty_cache()
+                self.next_batch = (False, None)
+            else:
+                raise
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        batch_is_valid, batch = self.next_batch
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            if batch_is_valid:
+                # tensors were allocated on the side stream, keep them alive until the main stream is done with them
+                for tensor in batch:
+                    if tensor.is_cuda: tensor.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch_is_valid, batch
+
+
+###################
+# GET GRAD SCALER #
+###################
+def get_grad_scaler(init_scale=2.**16, enabled=True):
+    ''' CUDA loss scaler for mixed precision training, a disabled scaler passes the loss and the optimizer step through untouched '''
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', init_scale=init_scale, enabled=enabled)
+    # torch < 2.3 only provides the (since deprecated) CUDA-specific class
+    return torch.cuda.amp.GradScaler(init_scale=init_scale, enabled=enabled)